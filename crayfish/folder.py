@@ -61,24 +61,27 @@ class FolderNode():
         """
         aggregate_frame = pypix.Frame(256, 256)
         self.get_children(extension_pattern)
+        clusters = []
         # For each sub_folder call its aggregate method and add its
         # clusters/pixels to the aggregate frame
         for folder_path in self.sub_folders:
             folder_frame = folder_path.calculate_aggregate(extension_pattern)
-            aggregate_frame.clusters += folder_frame.clusters
+            clusters += folder_frame.clusters
             for pixel in folder_frame.hit_pixels:
                 aggregate_frame[pixel] = pypix.Hit(aggregate_frame[pixel].value
                                                 + folder_frame[pixel].value)
-        # For each sub frame calculate its clusters if not already calculated
-        # and add these clusters (and the frame's pixels) to the aggregate frame
+        # For each sub frame calculate its clusters (a cached operation) and
+        # add these clusters (and the frame's pixels) to the aggregate frame
         for frame_file in self.sub_frames:
             frame = frame_file.frame
-            if not frame.clusters:
-                frame.calculate_clusters()
-            aggregate_frame.clusters += frame.clusters
+            frame.calculate_clusters()
+            clusters += frame.clusters
             for pixel in frame.hit_pixels:
                 aggregate_frame[pixel] = pypix.Hit(aggregate_frame[pixel].value
                                                 + frame[pixel].value)
+        # Assign the assembled list once all the pixels are in place, so it
+        # counts as current for the aggregate frame's final contents
+        aggregate_frame.clusters = clusters
         return aggregate_frame
 
     @property
@@ -49,15 +49,15 @@ def mean_count(self):
 def standard_deviation(self):
     if self.number_of_hits == 0: #Don't divide by zero
         return 0
-    mean_square = (float(sum([count**2 for count in self.counts]))
+    mean_square = (float(sum(count**2 for count in self.counts))
             /self.number_of_hits)
     square_mean = self.mean_count**2
     return (mean_square - square_mean)**0.5
 
 @attribute(Frame, "No. of clusters")
 def number_of_clusters(self):
-    if not self.clusters:
-        self.calculate_clusters()
+    # calculate_clusters only recomputes if the frame has changed
+    self.calculate_clusters()
     return len(self.clusters)
 
 @attribute(Cluster, "Geo. centre")
@@ -67,8 +67,10 @@ def geometric_centre(self):
 
 @attribute(Cluster, "C. of mass")
 def centre_of_mass(self):
-    weighted_hits = [tuple([self[hit].value * coord for coord in hit])
-            for hit in self.hit_pixels]
+    # hit_pixels and counts come from the same nonzero() scan, so zipping
+    # them pairs each pixel with its value without a grid lookup per hit
+    weighted_hits = [(value * x, value * y)
+            for (x, y), value in zip(self.hit_pixels, self.counts)]
     x_coords, y_coords = zip(*weighted_hits)
     total_weight = float(self.volume)
     return (sum(x_coords)/total_weight, sum(y_coords)/total_weight)
@@ -77,12 +79,8 @@ def centre_of_mass(self):
 def radius(self):
     # Call centre of mass once to save computing multiple times
     cofm_x, cofm_y = self.centre_of_mass
-    distances_squared = []
-    for pixel in self.hit_pixels:
-        x_diff = pixel[0] - cofm_x
-        y_diff = pixel[1] - cofm_y
-        distances_squared.append(x_diff**2 + y_diff**2)
-    return max(distances_squared)**0.5
+    return max((x - cofm_x)**2 + (y - cofm_y)**2
+            for x, y in self.hit_pixels)**0.5
 
 @attribute(Cluster, "Most neighbours", True)
 def most_neighbours(self):
@@ -10,7 +10,17 @@ Definitions:
     Count: A count is an integer corresponding to the value of a hit
 
 """
-from collections import OrderedDict
+import re
+from collections import OrderedDict, defaultdict
+from cStringIO import StringIO
+
+import numpy as np
+import scipy.ndimage
+
+# The 3x3 neighbourhood kernels used for neighbour counting and
+# 8-connectivity clustering, built once rather than on every call
+_NEIGHBOUR_KERNEL = np.ones((3,3), dtype=np.int8)
+_EIGHT_CONNECTIVITY = np.ones((3,3), dtype=bool)
 
 class Hit(object):
     """
@@ -18,41 +28,148 @@ class Hit(object):
 
     value: The value of the pixel
     cluster: The cluster that the pixel belongs to
+
+    A Hit may be free standing (as returned by Hit(value)) or bound to a
+    pixel of a PixelGrid (as returned by grid[pixel]). A bound hit reads and
+    writes its value and cluster straight through to the grid's arrays.
     """
+    # Frames hold thousands of hits, so skip the per-instance __dict__
+    __slots__ = ("_grid", "_pixel", "_value", "_cluster")
+
     def __init__(self, value, cluster=None):
-        self.value = value
-        self.cluster = None
+        self._grid = None
+        self._pixel = None
+        self._value = value
+        self._cluster = cluster
+
+    @property
+    def value(self):
+        if self._grid is not None:
+            x, y = self._pixel
+            return int(self._grid._values[y, x])
+        return self._value
+
+    @value.setter
+    def value(self, value):
+        if self._grid is not None:
+            x, y = self._pixel
+            self._grid._values[y, x] = value
+            self._grid._mutated()
+        else:
+            self._value = value
+
+    @property
+    def cluster(self):
+        if self._grid is not None:
+            return self._grid._cluster_at(self._pixel)
+        return self._cluster
+
+    @cluster.setter
+    def cluster(self, cluster):
+        if self._grid is not None:
+            self._grid._set_cluster_at(self._pixel, cluster)
+        else:
+            self._cluster = cluster
 
     # For debug purposes
     def __str__(self):
         return str(self.value)
 
-class PixelGrid(dict):
+class PixelGrid(object):
     """
     A base class that frame and cluster derive from. It contains methods
     applicable to any grid of pixels. Optional data argument may be a
     dictionary mapping (x,y) tuples to Hit objects
     """
-    # PixelGrid dictionary effectively implements a  sparse array. As most of
-    # the values of the 256*256 frame matrix will be 0, this greatly reduces
-    # the memory footprint of the programming, but does require slightly more
-    # processing to access each item in the array. If there is an attempt to
-    # retrieve a pixel co-ord that is not in the dictionary, the method
-    # __missing__ is called, which returns 0 if the pixel coords lie within the
-    # grid, or otherwise raise a KeyError.
+    # The grid is backed by two dense numpy arrays: one holding the pixel
+    # values and one holding the id of the cluster each pixel belongs to (0
+    # for unclustered). A dense 256*256 int32 array is only 256 KB - and as
+    # np.zeros allocates zeroed pages lazily, mostly-empty grids stay cheap -
+    # while letting the bulk operations (rendering, statistics, clustering)
+    # run as whole-array numpy operations rather than per-pixel dictionary
+    # lookups. The dictionary interface of the old sparse implementation
+    # (indexing, iteration over hit pixels, keys/values/update) is kept so
+    # that grids can still be treated as mappings of (x,y) to Hit.
     def __init__(self, width, height, data=[]):
-        super(PixelGrid, self).__init__(data)
         self.width = width
         self.height = height
+        self._values = np.zeros((height, width), dtype=np.int32)
+        self._cluster_ids = np.zeros((height, width), dtype=np.int32)
+        # Maps between cluster objects and the ids used in _cluster_ids
+        self._cluster_list = []
+        self._cluster_index = {}
+        self._gen = 0
+        self._bbox = None
+        self._bbox_gen = -1
+        self._neighbour_counts = None
+        self._neighbour_gen = -1
+        self.update(data)
+
+    def __getitem__(self, pixel):
+        if not self.in_grid(pixel):
+            raise KeyError("Point outside of PixelGrid")
+        hit = Hit(0)
+        hit._grid = self
+        hit._pixel = pixel
+        return hit
 
-    def __missing__(self, key):
-        # If we do not have an explicit Hit value for key (x,y), check to see
-        # if it appears i=within the grid. If so, return a Hit object with
-        # value 0
-        if self.in_grid(key):
-            return Hit(0)
-        else:
+    def __setitem__(self, pixel, hit):
+        if not self.in_grid(pixel):
             raise KeyError("Point outside of PixelGrid")
+        x, y = pixel
+        self._values[y, x] = hit.value
+        self._set_cluster_at(pixel, hit.cluster)
+        self._mutated()
+        # Bind the hit to this grid so that further reads and writes through
+        # it are reflected here
+        hit._grid = self
+        hit._pixel = pixel
+
+    def __contains__(self, pixel):
+        return self.in_grid(pixel) and self._values[pixel[1], pixel[0]] != 0
+
+    def __iter__(self):
+        return iter(self.hit_pixels)
+
+    def __len__(self):
+        return int(np.count_nonzero(self._values))
+
+    def keys(self):
+        return self.hit_pixels
+
+    def values(self):
+        return [self[pixel] for pixel in self.hit_pixels]
+
+    def update(self, data):
+        if hasattr(data, "items"):
+            data = data.items()
+        for pixel, hit in data:
+            self[pixel] = hit
+
+    def _cluster_at(self, pixel):
+        cluster_id = self._cluster_ids[pixel[1], pixel[0]]
+        if cluster_id:
+            return self._cluster_list[cluster_id - 1]
+        return None
+
+    def _register_cluster(self, cluster):
+        """
+        Return the id used for cluster in _cluster_ids, assigning the next
+        free id if the cluster has not been seen by this grid before.
+        """
+        cluster_id = self._cluster_index.get(cluster)
+        if cluster_id is None:
+            self._cluster_list.append(cluster)
+            cluster_id = len(self._cluster_list)
+            self._cluster_index[cluster] = cluster_id
+        return cluster_id
+
+    def _set_cluster_at(self, pixel, cluster):
+        if cluster is None:
+            cluster_id = 0
+        else:
+            cluster_id = self._register_cluster(cluster)
+        self._cluster_ids[pixel[1], pixel[0]] = cluster_id
 
     def in_grid(self, pixel):
         """
@@ -70,34 +187,69 @@ class PixelGrid(dict):
         """
         Returns a list of the locations of pixels showing hits
         """
-        return self.keys()
+        ys, xs = np.nonzero(self._values)
+        return zip(xs.tolist(), ys.tolist())
 
     @property
     def counts(self):
         """
         Returns a list of hit counts
         """
-        return [pixel.value for pixel in self.values()]
+        return self._values[self._values != 0].tolist()
+
+    def _mutated(self):
+        """
+        Called whenever a pixel value changes. Derived data (bounding box,
+        neighbour counts, clusters) is cached against this generation
+        counter, so bumping it lazily invalidates every cache at once.
+        """
+        self._gen += 1
+
+    @property
+    def bbox(self):
+        """
+        The bounding box of the hit pixels as a (min_x, max_x, min_y, max_y)
+        tuple. Computed in a single pass over the grid and cached until a
+        pixel value changes.
+        """
+        if self._bbox_gen != self._gen:
+            ys, xs = np.nonzero(self._values)
+            self._bbox = (int(xs.min()), int(xs.max()),
+                    int(ys.min()), int(ys.max()))
+            self._bbox_gen = self._gen
+        return self._bbox
 
     @property
     def min_x(self):
-        return min([pixel[0] for pixel in self.hit_pixels])
+        return self.bbox[0]
     @property
     def max_x(self):
-        return max([pixel[0] for pixel in self.hit_pixels])
+        return self.bbox[1]
     @property
     def min_y(self):
-        return min([pixel[1] for pixel in self.hit_pixels])
+        return self.bbox[2]
     @property
     def max_y(self):
-        return max([pixel[1] for pixel in self.hit_pixels])
+        return self.bbox[3]
+
+    @property
+    def _neighbours(self):
+        """
+        An array giving, for every pixel of the grid, the number of hits among
+        its 8 neighbours. Computed for the whole grid at once by convolving
+        the binary hit mask with a 3x3 ones kernel (and subtracting the pixel
+        itself), then cached until a pixel value changes.
+        """
+        if self._neighbour_gen != self._gen:
+            mask = (self._values != 0).astype(np.int8)
+            self._neighbour_counts = scipy.ndimage.convolve(mask,
+                    _NEIGHBOUR_KERNEL, mode="constant") - mask
+            self._neighbour_gen = self._gen
+        return self._neighbour_counts
 
     def number_of_neighbours(self, pixel):
         x, y = pixel
-        x_values = [x + offset for offset in [-1,0,1]]
-        y_values = [y + offset for offset in [-1,0,1]]
-        return sum([1 for i in x_values for j in y_values
-                if self.in_grid((i,j)) and (i,j) != pixel and self[i,j].value])
+        return int(self._neighbours[y, x])
 
     def get_max_neighbours(self):
         """
@@ -105,33 +257,23 @@ class PixelGrid(dict):
         one particular pixel has, and the second item is a list of the (x,y)
         locations of every pixel that has this many neighbours
         """
-        neighbours = {}
+        # defaultdict saves hashing each count twice on the in-check, and
+        # tracking the running maximum inline saves a second scan of the dict
+        neighbours = defaultdict(list)
+        max_neighbours = -1
         for pixel in self.hit_pixels:
             num_neighbours = self.number_of_neighbours(pixel)
-            if num_neighbours in neighbours:
-                neighbours[num_neighbours].append(pixel)
-            else:
-                neighbours[num_neighbours] = [pixel]
-        max_neighbours = max(neighbours)
+            neighbours[num_neighbours].append(pixel)
+            if num_neighbours > max_neighbours:
+                max_neighbours = num_neighbours
         return max_neighbours, neighbours[max_neighbours]
 
-        # ==Alternative Algorithm Implementation==
-        # neighbours = [(pixel, self.number_of_neighbours(pixel))
-        #         for pixel in self.hit_pixels]
-        # max_neighbours = max(neighbours, key = lambda x: x[1])[1]
-        # return max_neighbours, [pixel[0] for pixel in neighbours
-        #         if pixel[1] == max_neighbours]
-
     def render_energy(self):
         """
         Renders a grid with each value corresponding to the ernergy of the
         relevant pixel.
         """
-        grid = [[0]*self.width for _ in range(self.height)]
-        for pixel in self.hit_pixels:
-            x, y = pixel
-            grid[y][x] = self[pixel].value
-        return grid
+        return self._values.tolist()
 
     def render_energy_zoomed(self, min_x = None, min_y = None, max_x = None, max_y = None):
         """
@@ -142,8 +284,7 @@ class PixelGrid(dict):
         if not max_x: max_x = self.max_x
         if not min_y: min_y = self.min_y
         if not max_y: max_y = self.max_y
-        return [[self[x,y].value
-                for x in range(min_x, max_x+1)] for y in range(min_y, max_y+1)]
+        return self._values[min_y:max_y+1, min_x:max_x+1].tolist()
 
 
 class Frame(PixelGrid):
@@ -152,7 +293,25 @@ class Frame(PixelGrid):
     """
     def __init__(self,width=256, height=256, data=[]):
         super(Frame, self).__init__(width, height, data)
-        self.clusters = []
+        # Assigned directly (not through the clusters setter) so that a fresh
+        # frame's empty list is not mistaken for a current calculation
+        self._clusters = []
+        self._cluster_gen = -1
+        self._hit_xy = None
+        self._hit_cluster_ids = None
+        self._hit_xy_gen = -1
+
+    @property
+    def clusters(self):
+        return self._clusters
+
+    @clusters.setter
+    def clusters(self, clusters):
+        # An externally assembled cluster list (e.g. folder aggregation)
+        # counts as current for the frame's present contents, so sync the
+        # cluster generation to stop calculate_clusters discarding it
+        self._clusters = clusters
+        self._cluster_gen = self._gen
 
     @staticmethod
     def from_file(filepath, file_format = "lsc"):
@@ -167,27 +326,46 @@ class Frame(PixelGrid):
         if file_format == "lsc":
             frame = Frame()
             with open(filepath) as f:
-                try:
-                    for line in f:
-                        if line[:2] == "//":
-                            continue
-                        pixel, count = line.strip().split()
-                        pixel = tuple([int(coord) for coord in pixel.split(",")])
-                        frame[pixel] = Hit(int(count))
-                except:
-                    raise  Exception("Could not read \"" + filepath  + "\" as an lsc file"
-                           + "\n Please check the formatting.")
+                # Strip comment lines, then parse all the "x,y count" records
+                # in one go with numpy rather than splitting and int()-ing
+                # each line in Python.
+                lines = [line for line in f
+                        if line[:2] != "//" and line.strip()]
+            # The pattern is anchored to whole lines so that records with
+            # trailing junk ("11,20 4x0") are rejected rather than matched
+            # by a valid-looking prefix
+            data = np.fromregex(StringIO("".join(lines)),
+                    re.compile(r"^(\d+),(\d+)[ \t]+(\d+)[ \t]*\r?$", re.M),
+                    [("x", np.int32), ("y", np.int32), ("count", np.int32)])
+            if len(data) != len(lines):
+                # Some lines did not match the record format
+                raise Exception("Could not read \"" + filepath  + "\" as an lsc file"
+                       + "\n Please check the formatting.")
+            try:
+                for x, y, count in zip(data["x"].tolist(), data["y"].tolist(),
+                        data["count"].tolist()):
+                    frame[(x, y)] = Hit(count)
+            except KeyError:
+                # Record co-ordinates outside the 256x256 grid
+                raise Exception("Could not read \"" + filepath  + "\" as an lsc file"
+                       + "\n Please check the formatting.")
         elif file_format == "ascii_matrix":
             frame = Frame()
-            with open(filepath) as f:
-                try:
-                    for y, line in enumerate(f):
-                        for x, count in enumerate(line.strip().split(" ")):
-                            if int(count):
-                                frame[(int(x), int(y))] = Hit(int(count))
-                except:
-                    raise Exception("Could not read \"" + filepath + "\" as an ascii_matrix file"
-                            + "\n Please check the formatting.")
+            try:
+                matrix = np.loadtxt(filepath, dtype=np.int32, ndmin=2)
+            except ValueError:
+                raise Exception("Could not read \"" + filepath + "\" as an ascii_matrix file"
+                        + "\n Please check the formatting.")
+            ys, xs = np.nonzero(matrix)
+            counts = matrix[ys, xs]
+            try:
+                for x, y, count in zip(xs.tolist(), ys.tolist(),
+                        counts.tolist()):
+                    frame[(x, y)] = Hit(count)
+            except KeyError:
+                # Matrix larger than the 256x256 grid
+                raise Exception("Could not read \"" + filepath + "\" as an ascii_matrix file"
+                        + "\n Please check the formatting.")
         else:
             raise Exception("File format not supported: " + file_format)
         return frame
@@ -195,63 +373,76 @@ class Frame(PixelGrid):
     def calculate_clusters(self):
         """
         Called to calculated clusters. This is an expensive operation that is
-        cached, ie. calling this function will not recalculate clusters if they
-        have already been calculated.
+        cached against the frame's mutation generation, ie. calling this
+        function will only recalculate clusters if a pixel value has changed
+        since they were last calculated.
 
         Returns the list of clusters.
         """
-        if not self.clusters:
+        if self._cluster_gen != self._gen:
+            self._cluster_gen = self._gen
             self.clusters = []
-            for pixel in self.hit_pixels:
-                if not self[pixel].cluster: # If pixel not already clustered
-                    new_cluster = Cluster(256, 256)
-                    self.clusters.append(new_cluster)
-                    new_cluster.add(pixel, self[pixel])
-                    self._add_neighbouring_pixels(pixel, new_cluster)
+            self._cluster_ids[:] = 0
+            # Clustering is connected component labelling on the hit mask, so
+            # hand the whole grid to scipy.ndimage.label (a compiled
+            # union-find) with the 3x3 structuring element for
+            # 8-connectivity, then split the hits up by label.
+            labels, number_of_labels = scipy.ndimage.label(
+                    self._values != 0, structure=_EIGHT_CONNECTIVITY)
+            if number_of_labels == 0:
+                return self.clusters
+            # Group the hit pixels by label with a single stable sort and
+            # split, rather than scanning the whole grid once per label with
+            # a labels == label mask
+            ys, xs = np.nonzero(labels)
+            pixel_labels = labels[ys, xs]
+            order = np.argsort(pixel_labels, kind="mergesort")
+            ys, xs = ys[order], xs[order]
+            boundaries = np.searchsorted(pixel_labels[order],
+                    np.arange(2, number_of_labels + 1))
+            for label_ys, label_xs in zip(np.split(ys, boundaries),
+                    np.split(xs, boundaries)):
+                new_cluster = Cluster(256, 256)
+                self.clusters.append(new_cluster)
+                # Copy the labelled pixels and stamp the cluster id into both
+                # grids with indexed array assignments, rather than routing a
+                # bound Hit facade through add() for every pixel
+                new_cluster._values[label_ys, label_xs] = (
+                        self._values[label_ys, label_xs])
+                new_cluster._cluster_ids[label_ys, label_xs] = (
+                        new_cluster._register_cluster(new_cluster))
+                self._cluster_ids[label_ys, label_xs] = (
+                        self._register_cluster(new_cluster))
+                new_cluster._mutated()
         return self.clusters
 
-    def _add_neighbouring_pixels(self, pixel, cluster):
-        """
-        Adds all pixels neighbours of `pixel` to `cluster` if they are not already
-        clustered.
-        """
-        x, y = pixel
-        x_values = [x + offset for offset in [-1,0,1]]
-        y_values = [y + offset for offset in [-1,0,1]]
-        new_pixels =  [(i, j) for i in x_values for j in y_values
-                if self.in_grid((i,j)) and self[(i,j)].value != 0
-            and not self[(i,j)].cluster]  # and  (i,j) != pixel 
-                                        # (Don't need to check as the current
-                                        # pixel will be already clustered)
-        # These for loops are done sequentially to prevent a hit from being added twice.
-        for new_pixel in new_pixels:
-            cluster.add(new_pixel, self[new_pixel])
-        for new_pixel in new_pixels:
-            # Recursively add the neighbours of the new pixel
-            self._add_neighbouring_pixels(new_pixel, cluster)
-
 
     def get_closest_cluster(self, point):
         """
         Returns the closest cluster to a pixel.
         """
-        if not self.clusters:
-            self.calculate_clusters()
+        self.calculate_clusters()
+        if self._hit_xy_gen != self._gen:
+            # Cache the hit co-ordinates and their cluster ids as parallel
+            # arrays so each query is just vectorised arithmetic + argmin
+            ys, xs = np.nonzero(self._values)
+            self._hit_xy = np.column_stack((xs, ys))
+            self._hit_cluster_ids = self._cluster_ids[ys, xs]
+            self._hit_xy_gen = self._gen
         x, y = point
-        square_distances = []
-        for pixel in self.hit_pixels:
-            pixel_x, pixel_y = pixel
-            x_diff = pixel_x - x
-            y_diff = pixel_y - y
-            square_distances.append((self[pixel].cluster, x_diff**2 + y_diff**2))
-        return min(square_distances, key=lambda x: x[1])[0]
+        square_distances = ((self._hit_xy[:,0] - x)**2
+                        + (self._hit_xy[:,1] - y)**2)
+        cluster_id = self._hit_cluster_ids[square_distances.argmin()]
+        return self._cluster_list[cluster_id - 1]
 
     def get_training_rows(self):
         """
         Outputs a training row for each manually classified cluster.
         """
-        return "\n".join([cluster.get_training_row() for cluster in self.clusters
-                        if cluster.manual_class != "Unclassified"])
+        classified = [cluster for cluster in self.clusters
+                if cluster.manual_class != "Unclassified"]
+        return "\n".join(cluster.get_training_row()
+                for cluster in classified)
 
     def load_training_data(self, data):
         """
@@ -260,10 +451,13 @@ class Frame(PixelGrid):
         Args:
             Data: A dictionary mapping cluster UUIDs to classes
         """
-        for UUID_key in data:
-            for cluster in self.clusters:
-                if UUID_key == cluster.UUID:
-                    cluster.manual_class = data[UUID_key]
+        # Index the clusters by UUID once rather than rescanning the cluster
+        # list for every entry in data
+        clusters_by_UUID = dict((cluster.UUID, cluster)
+                for cluster in self.clusters)
+        for UUID_key, manual_class in data.items():
+            if UUID_key in clusters_by_UUID:
+                clusters_by_UUID[UUID_key].manual_class = manual_class
 
 class Cluster(PixelGrid):
     """
@@ -304,23 +498,16 @@ class Cluster(PixelGrid):
         Returns an ascii grid representation of the cluster, with rows
         separated by new line characters and columns separated by tabs.
         """
-        grid = [[0] * self.cluster_width for _ in range(self.cluster_height)]
-        for pixel in self.hit_pixels:
-            x, y = pixel
-            grid[y - self.min_y][x - self.min_x] = self[pixel].value
-        # CERN@School/Pixelman convention to have lower origin, so flip matrix vertically.
-        grid.reverse()
-        return "\n".join(["\t".join([str(value) for value in row]) for row in grid])
+        # CERN@School/Pixelman convention to have lower origin, so flip the
+        # bounding-box slice vertically.
+        grid = self._values[self.min_y:self.max_y+1,
+                self.min_x:self.max_x+1][::-1]
+        return "\n".join(["\t".join([str(value) for value in row])
+                for row in grid.tolist()])
 
-    def get_training_row(self):
-        """
-        Returns a training row corresponding to this cluster.
-        """
-        record = [self.UUID, self.manual_class]
-        record += [str(attribute_table[attr][0](self)) for attr in attribute_table
-                if isinstance(self, attribute_table[attr][1]) and
-                    attribute_table[attr][3]]
-        return ",".join(record)
+    # get_training_row is generated at import time, once the attribute table
+    # has been populated - see _generate_training_row at the bottom of this
+    # module
 
 
 def are_neighbours(pixel1,pixel2):
@@ -334,9 +521,16 @@ def are_neighbours(pixel1,pixel2):
     return abs(x2 - x1) <= 1 and abs (y2 - y1) <= 1
 
 # Use an ordered dict so that the table maintains the order in which
-# attributes are defined in attributes.py
+# attributes are defined in attributes.py (plain dicts only preserve
+# insertion order from Python 3.7, not on the 2.7 runtime this targets)
 attribute_table = OrderedDict()
 
+# Trainable attribute functions with their declared class, in declaration
+# order. Recorded by the attribute decorator as attributes are defined so
+# that training-row generation does not have to filter the full
+# attribute_table afterwards.
+_trainable_attributes = []
+
 def attribute(class_, name, plottable=False, trainable=None):
     """
     A function decorator that adds a function to the attribute table along with
@@ -362,9 +556,39 @@ def attribute(class_, name, plottable=False, trainable=None):
         trainable = plottable
     def decorator(function):
         attribute_table[name] = (function, class_, plottable, trainable)
+        if trainable:
+            _trainable_attributes.append((function, class_))
         setattr(class_, function.__name__, property(function))
         return function
     return decorator
 
 # Import attributes
 from attributes import *
+
+def _generate_training_row():
+    """
+    Generates Cluster.get_training_row specialised to the trainable
+    attributes registered in attribute_table.
+
+    The attribute table is static once attributes.py has been imported, so
+    rather than filtering the whole table by class and trainability on every
+    call, the trainable attributes recorded by the attribute decorator are
+    resolved against Cluster once here and a function is compiled that calls
+    each of them directly.
+    """
+    functions = [function for function, class_ in _trainable_attributes
+            if issubclass(Cluster, class_)]
+    namespace = dict(("_attribute_%d" % i, function)
+            for i, function in enumerate(functions))
+    fields = ["self.UUID", "self.manual_class"]
+    fields += ["str(_attribute_%d(self))" % i for i in range(len(functions))]
+    source = (
+        'def get_training_row(self):\n'
+        '    """\n'
+        '    Returns a training row corresponding to this cluster.\n'
+        '    """\n'
+        '    return ",".join([' + ", ".join(fields) + '])\n')
+    exec source in namespace
+    return namespace["get_training_row"]
+
+Cluster.get_training_row = _generate_training_row()
@@ -1,3 +1,5 @@
+import os
+import tempfile
 import unittest
 from pypix import *
 
@@ -140,5 +142,38 @@ class TestFrame(unittest.TestCase):
         correct_cluster_pixels = [cluster.keys().sort() for cluster in CLUSTERS]
         self.assertItemsEqual(frame_cluster_pixels, correct_cluster_pixels)
 
+class TestFromFile(unittest.TestCase):
+
+    # Write body out to a temporary lsc file and read it back as a frame
+    def load_lsc(self, body):
+        handle, path = tempfile.mkstemp(suffix=".lsc")
+        try:
+            with os.fdopen(handle, "wb") as f:
+                f.write(body)
+            return Frame.from_file(path)
+        finally:
+            os.remove(path)
+
+    def test_crlf_line_endings(self):
+        # Test 11
+        # Pixelman exports are tab separated with \r\n line endings, which
+        # must parse the same as the \n-only test frame
+        f = self.load_lsc("//FINF,LSC,1.0\r\n175,10\t51\r\n176,10\t82\r\n")
+        self.assertEqual(f[(175,10)].value, 51)
+        self.assertEqual(f[(176,10)].value, 82)
+        self.assertEqual(len(f.hit_pixels), 2)
+
+    def test_malformed_counts(self):
+        # Records whose counts are not plain integers must be rejected, not
+        # loaded from a valid-looking prefix
+        # Test 12.1
+        self.assertRaises(Exception, lambda: self.load_lsc("11,20 4x0\n"))
+        # Test 12.2
+        self.assertRaises(Exception, lambda: self.load_lsc("10,20 1e5\n"))
+
+    def test_out_of_grid_record(self):
+        # Test 13
+        self.assertRaises(Exception, lambda: self.load_lsc("500,500 10\n"))
+
 # Run the tests
 unittest.main(verbosity=2)